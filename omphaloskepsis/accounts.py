@@ -1,12 +1,15 @@
 import base64
+import collections
 import os
 import random
 import re
 import struct
+import threading
 import time
 
 from . import db
 from . import measurements
+from . import migrations
 
 Model = db.declarative_base()
 
@@ -28,11 +31,33 @@ def create(root, x):
         os.unlink(p)
     engine = db.engine(p)
     measurements.Model.metadata.create_all(engine)
+    with engine.begin() as conn:
+        migrations.stamp(conn)
+    _current.add(p)
     sess = db.sessionmaker(bind=engine, autoflush=False)()
     sess.add(measurements.Profile())
     sess.commit()
 
 
+# paths whose schema has been checked against migrations.LATEST in this process.
+_current = set()
+_upgrading = collections.defaultdict(threading.Lock)
+
+# memory allowance shared by all account databases open in this process.
+budget = db.Budget()
+
+def engine(root, x, echo=False):
+    p = path(root, x)
+    engine = budget.engine(p, echo)
+    if p not in _current:
+        with _upgrading[p]:
+            if p not in _current:
+                migrations.upgrade(engine)
+                _current.add(p)
+        _upgrading.pop(p, None)
+    return engine
+
+
 def AccountIdColumn():
     fk = db.ForeignKey('accounts.id', onupdate='CASCADE', ondelete='CASCADE')
     return db.Column(db.Integer, fk, nullable=False)
@@ -162,3 +187,32 @@ class Key(Model):
             keyid=self.keyid,
             pubkey=self.pubkey,
         )
+
+
+class Outbox(Model):
+    __tablename__ = 'outbox'
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    created_utc = db.Column(db.Integer, default=time.time, nullable=False)
+    send_after_utc = db.Column(db.Integer, default=time.time, index=True, nullable=False)
+    sent_utc = db.Column(db.Integer, default=-1, index=True, nullable=False)
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    last_error = db.Column(db.String)
+
+    sender = db.Column(db.String, nullable=False)
+    recipients = db.Column(db.String, nullable=False)
+    subject = db.Column(db.String, nullable=False)
+    body = db.Column(db.Text, nullable=False)
+
+    def to_dict(self):
+        return dict(
+            id=self.id,
+            created_utc=self.created_utc,
+            send_after_utc=self.send_after_utc,
+            sent_utc=self.sent_utc,
+            attempts=self.attempts,
+            last_error=self.last_error,
+            recipients=self.recipients.split(','),
+            subject=self.subject,
+        )
@@ -9,6 +9,18 @@ def _expand(s):
     return os.path.abspath(os.path.expandvars(os.path.expanduser(s)))
 
 
+def _smtp_connection(smtp, tls):
+    from . import outbox
+    host, _, port = smtp.partition(':')
+    return outbox.Connection(
+        host=host or 'localhost',
+        port=int(port or 25),
+        use_tls=tls,
+        username=os.environ.get('OMPHALOSKEPSIS_SMTP_USER'),
+        password=os.environ.get('OMPHALOSKEPSIS_SMTP_PASSWORD'),
+    )
+
+
 @click.group()
 @click.option('--db', default='', metavar='FILE',
               help='Use database stored in FILE.')
@@ -51,7 +63,7 @@ def init(ctx, config, emails):
         account.passwords.append(accounts.Password(password=hashed))
         sess.add(account)
         sess.commit()
-        account.create_db(root)
+        accounts.create(root, account.id)
 
 
 @cli.command()
@@ -68,15 +80,28 @@ def init(ctx, config, emails):
               help='Only accept session cookies at this domain.')
 @click.option('--assets', default=None, metavar='DIR',
               help='Access static / template assets from DIR.')
+@click.option('--smtp', default='localhost:25', metavar='HOST:PORT',
+              help='Deliver outgoing email via SMTP at HOST:PORT.')
+@click.option('--smtp-tls/--no-smtp-tls', default=False)
+@click.option('--memory', default=256, metavar='MB',
+              help='Share MB of page cache among open account databases.')
+@click.option('--storage-profile', default='hot',
+              type=click.Choice(['cold', 'warm', 'hot']),
+              help='Per-connection cache, mmap and temp storage settings.')
 @click.pass_context
-def serve(ctx, host, port, config, debug, secret, domain, assets):
+def serve(ctx, host, port, config, debug, secret, domain, assets, smtp, smtp_tls,
+          memory, storage_profile):
+    from . import outbox
     from .serve import create_app
+    outbox.start(ctx.obj['db'], _smtp_connection(smtp, smtp_tls))
     app = create_app(ctx.obj['db'],
                      debug=debug,
                      secret=secret,
                      domain=domain,
                      config_path=config,
-                     assets=assets)
+                     assets=assets,
+                     memory_mb=memory,
+                     storage_profile=storage_profile)
     if debug:
         app.run(host=host, port=port, debug=True, threaded=False, processes=1)
     else:
@@ -84,5 +109,120 @@ def serve(ctx, host, port, config, debug, secret, domain, assets):
         gevent.pywsgi.WSGIServer((host, port), app).serve_forever()
 
 
+def _account_dbs(db_path):
+    import sqlalchemy
+    from . import accounts, db
+
+    root = os.path.dirname(db_path)
+    sess = db.sessionmaker(bind=db.engine(db_path), autoflush=False)()
+    for aid in sess.scalars(sqlalchemy.select(accounts.Account.id)):
+        p = accounts.path(root, aid)
+        if os.path.exists(p):
+            yield accounts.encode_id(aid).decode('utf8'), p
+
+
+# Runs rebuild(connection) on every account database, upgrading its schema
+# first, and reports each result or failure.
+def _rebuild_accounts(ctx, rebuild, noun):
+    from . import db, migrations
+
+    failures = 0
+    for name, p in _account_dbs(ctx.obj['db']):
+        engine = db.engine(p)
+        try:
+            migrations.upgrade(engine)
+            with engine.begin() as conn:
+                count = rebuild(conn)
+        except Exception as e:
+            failures += 1
+            click.echo(f'{name}: {e!r}', err=True)
+        else:
+            click.echo(f'{name}: {count} {noun}')
+        finally:
+            engine.dispose()
+    ctx.exit(1 if failures else 0)
+
+
+@cli.command()
+@click.pass_context
+def reindex(ctx):
+    from . import measurements
+    _rebuild_accounts(ctx, measurements.rebuild_search, 'indexed')
+
+
+@cli.command('recompute-habits')
+@click.pass_context
+def recompute_habits(ctx):
+    from . import measurements
+    _rebuild_accounts(ctx, measurements.recompute_habits, 'habits')
+
+
+@cli.command()
+@click.option('--workers', default=4, metavar='N',
+              help='Migrate at most N databases at once.')
+@click.pass_context
+def migrate(ctx, workers):
+    from . import migrations
+
+    paths = migrations.shards(os.path.dirname(ctx.obj['db']))
+    upgraded = failures = 0
+    with click.progressbar(length=len(paths), label='Migrating') as bar:
+        for path, result, error in migrations.upgrade_all(paths, workers=workers):
+            bar.update(1)
+            if error:
+                failures += 1
+                click.echo(f'\n{path}: {error!r}', err=True)
+            elif result[0] < result[1]:
+                upgraded += 1
+    current = len(paths) - upgraded - failures
+    click.echo(f'{upgraded} upgraded, {current} already current, {failures} failed')
+    ctx.exit(1 if failures else 0)
+
+
+@cli.group('outbox')
+def outbox_():
+    pass
+
+
+@outbox_.command()
+@click.option('--limit', default=20, metavar='N',
+              help='List at most N undelivered messages.')
+@click.pass_context
+def status(ctx, limit):
+    import sqlalchemy
+    from . import accounts, db, outbox
+
+    outbox.create_table(ctx.obj['db'])
+    sess = db.sessionmaker(bind=db.engine(ctx.obj['db']), autoflush=False)()
+    for key, value in outbox.summary(sess).items():
+        click.echo(f'{key}: {value}')
+    for message in sess.scalars(sqlalchemy.select(accounts.Outbox).where(
+            accounts.Outbox.sent_utc < 0,
+    ).order_by(accounts.Outbox.send_after_utc).limit(limit)):
+        m = message.to_dict()
+        click.echo(f'#{m["id"]} to {",".join(m["recipients"])} attempts={m["attempts"]} '
+                   f'next={time.ctime(m["send_after_utc"])} {m["last_error"] or ""}')
+
+
+@outbox_.command()
+@click.option('--smtp', default='localhost:25', metavar='HOST:PORT',
+              help='Deliver outgoing email via SMTP at HOST:PORT.')
+@click.option('--smtp-tls/--no-smtp-tls', default=False)
+@click.pass_context
+def drain(ctx, smtp, smtp_tls):
+    from . import db, outbox
+
+    outbox.create_table(ctx.obj['db'])
+    sess = db.sessionmaker(bind=db.engine(ctx.obj['db']), autoflush=False)()
+    connection = _smtp_connection(smtp, smtp_tls)
+    try:
+        while outbox.deliver(sess, connection):
+            pass
+    finally:
+        connection.close()
+    click.echo(', '.join(f'{k}: {v}' for k, v in sorted(outbox.stats.items()))
+               or 'nothing due')
+
+
 if __name__ == '__main__':
     main()
@@ -1,12 +1,137 @@
+import collections
+import functools
+import logging
+import threading
+
 import sqlalchemy
 
 # Create some aliases for sqlalchemy symbols.
-from sqlalchemy import Column, Float, ForeignKey, Integer, LargeBinary, String, Text
-from sqlalchemy.orm import backref, declarative_base, relationship, sessionmaker
+from sqlalchemy import Column, DDL, Float, ForeignKey, Integer, LargeBinary, String
+from sqlalchemy import Text, event, inspect, select, text, update
+from sqlalchemy.orm import backref, column_property, declarative_base, relationship
+from sqlalchemy.orm import sessionmaker
+
+log = logging.getLogger(__name__)
+
+
+# Per-connection storage settings. cache_kib and mmap_bytes are upper bounds;
+# a Budget may hand out less when many databases are open.
+StorageProfile = collections.namedtuple(
+    'StorageProfile', 'cache_kib mmap_bytes temp_store statements')
+
+PROFILES = dict(
+    cold=StorageProfile(
+        cache_kib=512, mmap_bytes=0, temp_store='FILE', statements=16),
+    warm=StorageProfile(
+        cache_kib=4096, mmap_bytes=0, temp_store='MEMORY', statements=64),
+    hot=StorageProfile(
+        cache_kib=16384, mmap_bytes=256 << 20, temp_store='MEMORY', statements=128),
+)
+
+
+def engine(path, echo=False, **kwargs):
+    return sqlalchemy.create_engine(f'sqlite:///{path}', echo=echo, **kwargs)
+
+
+def apply_profile(dbapi_connection, profile, allowance=None):
+    cache = profile.cache_kib << 10
+    mmap = profile.mmap_bytes
+    if allowance is not None:
+        cache = min(cache, allowance)
+        mmap = min(mmap, allowance - cache)
+    cur = dbapi_connection.cursor()
+    cur.execute(f'PRAGMA cache_size = -{max(cache >> 10, 64)}')
+    cur.execute(f'PRAGMA mmap_size = {max(mmap, 0)}')
+    cur.execute(f'PRAGMA temp_store = {profile.temp_store}')
+    cur.close()
+
+
+# Divides a fixed memory allowance (page cache plus mmap) among open database
+# engines. Engines are kept in least-recently-used order: the `hot` most
+# recent ones run with the budget's profile, the rest with the cold profile,
+# and when the average share would fall below min_bytes, the coldest engines
+# are disposed. Settings are applied to connections as they are checked out
+# and back in; idle connections are only closed when their engine changes
+# profile or its allowance falls by SHRINK or more.
+class Budget:
+    # at most this many pooled connections per engine, each with its own cache.
+    CONNECTIONS = 2
+    SHRINK = 4
+
+    def __init__(self, total_bytes=256 << 20, profile='hot', min_bytes=1 << 20,
+                 hot=4):
+        self.total_bytes = total_bytes
+        self.profile = PROFILES[profile]
+        self.min_bytes = min_bytes
+        self.hot = hot
+        self._engines = collections.OrderedDict()
+        self._settings = {}
+        self._hot = set()
+        self._lock = threading.Lock()
+
+    def resize(self, total_bytes=None, profile=None, hot=None):
+        with self._lock:
+            if total_bytes is not None:
+                self.total_bytes = total_bytes
+            if profile is not None:
+                self.profile = PROFILES[profile]
+            if hot is not None:
+                self.hot = hot
+            self._rebalance()
+
+    def engine(self, path, echo=False):
+        with self._lock:
+            if path in self._engines:
+                self._engines.move_to_end(path)
+                # an engine that was already hot stays hot; nothing else moves.
+                if path not in self._hot:
+                    self._rebalance()
+                return self._engines[path]
+            eng = engine(path, echo, pool_size=1, max_overflow=self.CONNECTIONS - 1)
+            apply = functools.partial(self._apply, path)
+            sqlalchemy.event.listen(eng, 'do_connect', functools.partial(
+                self._connect, path))
+            sqlalchemy.event.listen(eng, 'checkout', apply)
+            sqlalchemy.event.listen(eng, 'checkin', apply)
+            self._engines[path] = eng
+            self._rebalance()
+            return eng
+
+    def _rebalance(self):
+        per_engine = lambda: self.total_bytes // max(1, len(self._engines))
+        while len(self._engines) > 1 and per_engine() < self.min_bytes:
+            path, eng = self._engines.popitem(last=False)
+            self._settings.pop(path, None)
+            eng.dispose()
+            log.info('budget: closed %s, %d databases open', path, len(self._engines))
+        cold = PROFILES['cold']
+        n_hot = min(self.hot, len(self._engines))
+        n_cold = len(self._engines) - n_hot
+        cold_share = min(cold.cache_kib << 10, per_engine() // self.CONNECTIONS)
+        hot_share = (self.total_bytes - n_cold * self.CONNECTIONS * cold_share) // \
+            max(1, n_hot * self.CONNECTIONS)
+        self._hot = set(list(self._engines)[len(self._engines) - n_hot:])
+        for path in self._engines:
+            new = (self.profile, hot_share) if path in self._hot else (cold, cold_share)
+            old = self._settings.get(path)
+            self._settings[path] = new
+            if old is not None and (old[0] != new[0] or new[1] * self.SHRINK <= old[1]):
+                self._engines[path].pool.dispose()
 
+    # cached_statements is fixed when a connection opens, so it comes from the
+    # engine's profile at that time.
+    def _connect(self, path, dialect, connection_record, cargs, cparams):
+        setting = self._settings.get(path)
+        if setting is not None:
+            cparams['cached_statements'] = setting[0].statements
 
-def engine(path, echo=False):
-    return sqlalchemy.create_engine(f'sqlite:///{path}', echo=echo)
+    def _apply(self, path, dbapi_connection, connection_record, *args):
+        setting = self._settings.get(path)
+        if dbapi_connection is None or setting is None:
+            return
+        if connection_record.info.get('applied') != setting:
+            apply_profile(dbapi_connection, *setting)
+            connection_record.info['applied'] = setting
 
 
 @sqlalchemy.event.listens_for(sqlalchemy.engine.Engine, 'connect')
@@ -0,0 +1,82 @@
+import array
+import json
+import sys
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON = 'application/json'
+COLUMNS = 'application/vnd.omphaloskepsis.columns+json'
+MSGPACK = 'application/msgpack'
+
+# msgpack extension codes for columns packed as little-endian typed buffers.
+# Numeric columns with missing values are sent as float64, with NaN for gaps.
+FLOAT64 = 1
+INT64 = 2
+
+
+def offers():
+    return (JSON, COLUMNS, MSGPACK) if msgpack else (JSON, COLUMNS)
+
+
+def negotiate(accept):
+    return accept.best_match(offers(), default=JSON)
+
+
+def columnar(obj):
+    if isinstance(obj, dict):
+        return {k: columnar(v) for k, v in obj.items()}
+    if not isinstance(obj, list) or not obj:
+        return obj
+    if not all(isinstance(r, dict) for r in obj):
+        return obj
+    keys = sorted({k for row in obj for k in row if k != 'kv'})
+    cols = {k: [row.get(k) for row in obj] for k in keys}
+    kvs = [row.get('kv') or {} for row in obj]
+    kv_keys = sorted({k for kv in kvs for k in kv})
+    if kv_keys:
+        cols['kv'] = {k: [kv.get(k) for kv in kvs] for k in kv_keys}
+    return cols
+
+
+def _typed(values):
+    if any(isinstance(v, bool) for v in values):
+        return None
+    if not all(v is None or isinstance(v, (int, float)) for v in values):
+        return None
+    present = [v for v in values if v is not None]
+    if not present:
+        return None
+    if any(isinstance(v, int) and not -2 ** 53 <= v <= 2 ** 53 for v in present):
+        if len(present) < len(values) or not all(isinstance(v, int) for v in values):
+            return None
+    if len(present) == len(values) and all(isinstance(v, int) for v in values):
+        if all(-2 ** 63 <= v < 2 ** 63 for v in values):
+            return INT64, array.array('q', values)
+        return None
+    nan = float('nan')
+    return FLOAT64, array.array('d', (nan if v is None else v for v in values))
+
+
+def _packed(obj):
+    if isinstance(obj, dict):
+        return {k: _packed(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        typed = _typed(obj)
+        if typed is None:
+            return [_packed(v) for v in obj]
+        code, buf = typed
+        if sys.byteorder == 'big':
+            buf.byteswap()
+        return msgpack.ExtType(code, buf.tobytes())
+    return obj
+
+
+def render(obj, mimetype):
+    if mimetype == COLUMNS:
+        return json.dumps(columnar(obj)).encode('utf8')
+    if mimetype == MSGPACK:
+        return msgpack.packb(_packed(columnar(obj)), use_bin_type=True)
+    return json.dumps(obj).encode('utf8')
@@ -0,0 +1,106 @@
+import datetime
+import re
+import zoneinfo
+
+UNITS = dict(hour=3600, day=86400, week=7 * 86400, month=30 * 86400, year=365 * 86400)
+
+# e.g. "2 per 3 days", "1x/week", "5 times every month"
+GOAL = re.compile(r'(\d+)\s*(?:x|times?)?\s*(?:per|every|/)\s*(\d*)\s*'
+                  r'(hour|day|week|month|year)s?', re.I)
+
+
+# Goals are [count, n, unit]: at least count snapshots in every n units.
+def parse_goals(kv):
+    goals = []
+    if isinstance(kv.get('goals'), str):
+        for clause in re.split(r'[,;\n]', kv['goals']):
+            m = GOAL.search(clause)
+            if m and int(m[1]) > 0:
+                goals.append([int(m[1]), int(m[2] or 1), m[3].lower()])
+    count, seconds = kv.get('goal'), kv.get('perSeconds')
+    numeric = all(isinstance(v, (int, float)) and not isinstance(v, bool)
+                  for v in (count, seconds))
+    if not goals and numeric:
+        if count > 0 and seconds > 0:
+            goals.append([int(count), *_period(int(seconds))])
+    return goals
+
+
+def _period(seconds):
+    for unit in ('year', 'month', 'week', 'day', 'hour'):
+        if seconds % UNITS[unit] == 0:
+            return [seconds // UNITS[unit], unit]
+    return [seconds, 'second']
+
+
+def _zone(tz):
+    try:
+        return zoneinfo.ZoneInfo(tz) if tz else datetime.timezone.utc
+    except (ValueError, zoneinfo.ZoneInfoNotFoundError):
+        return datetime.timezone.utc
+
+
+# Periods are counted in the snapshot's local calendar: days run from local
+# midnight, weeks start on Monday, and months and years follow the calendar.
+def period_key(utc, tz, n, unit):
+    local = datetime.datetime.fromtimestamp(utc, _zone(tz))
+    if unit == 'year':
+        index = local.year
+    elif unit == 'month':
+        index = local.year * 12 + local.month - 1
+    elif unit in ('week', 'day'):
+        index = local.date().toordinal()
+        index = (index - 1) // 7 if unit == 'week' else index
+    else:
+        seconds = int(utc + local.utcoffset().total_seconds())
+        index = seconds // 3600 if unit == 'hour' else seconds
+    return index // n
+
+
+# Habit state holds, for each goal, the number of snapshots in each period,
+# plus the most recent time zone, which decides where "now" falls.
+def initial(goals):
+    return dict(goals=goals, periods=[{} for _ in goals], tz=None, tz_utc=None)
+
+
+def add(state, utc, tz, delta=1):
+    if delta > 0 and tz and (state.get('tz_utc') is None or utc >= state['tz_utc']):
+        state['tz'], state['tz_utc'] = tz, utc
+    for (count, n, unit), periods in zip(state['goals'], state['periods']):
+        key = str(period_key(utc, tz, n, unit))
+        total = periods.get(key, 0) + delta
+        if total > 0:
+            periods[key] = total
+        else:
+            periods.pop(key, None)
+    return state
+
+
+def summarize(state, now):
+    result = []
+    goals, tz = state.get('goals', ()), state.get('tz')
+    for (count, n, unit), periods in zip(goals, state.get('periods', ())):
+        current = period_key(now, tz, n, unit)
+        seen = [int(k) for k in periods if int(k) <= current]
+        done = sorted(int(k) for k, c in periods.items()
+                      if c >= count and int(k) <= current)
+        best = run = 0
+        for i, idx in enumerate(done):
+            run = run + 1 if i and done[i - 1] == idx - 1 else 1
+            best = max(best, run)
+        # an unfinished current period doesn't break the streak yet.
+        streak = run if done and done[-1] >= current - 1 else 0
+        # nor does it count against the rate until it is met.
+        total = current - min(seen) + (current in done) if seen else 0
+        result.append(dict(
+            count=count,
+            period=n,
+            unit=unit,
+            this_period=periods.get(str(current), 0),
+            current_streak=streak,
+            best_streak=best,
+            completed_periods=len(done),
+            total_periods=total,
+            completion_rate=len(done) / total if total else 0,
+        ))
+    return result
@@ -2,6 +2,7 @@ import json
 import zlib
 
 from . import db
+from . import habits
 
 Model = db.declarative_base()
 
@@ -39,10 +40,10 @@ class Profile(Model):
     kv = db.Column(db.LargeBinary)
 
     def update_from(self, data):
-        self.kv = db.update_json(self.kv, data, Profile.STRINGS)
+        self.kv = update_json(self.kv, data, Profile.STRINGS)
 
     def to_dict(self):
-        return dict(kv=db.decompress_json(self.kv))
+        return dict(kv=decompress_json(self.kv))
 
 
 class Collection(Model):
@@ -56,18 +57,26 @@ class Collection(Model):
 
     kv = db.Column(db.LargeBinary)
 
+    # incremental habit state, maintained by the listeners below.
+    state = db.Column(db.LargeBinary)
+
     def update_from(self, data):
         if data.get('flavor', '').lower() in ('habit', 'sleep', 'workout'):
             self.flavor = data.pop('flavor').lower()
-        self.kv = db.update_json(self.kv, data, Collection.STRINGS)
+        self.kv = update_json(self.kv, data, Collection.STRINGS)
 
-    def to_dict(self):
-        return dict(
+    def habit_progress(self, now):
+        return habits.summarize(decompress_json(self.state), now)
+
+    def to_dict(self, snapshots=True):
+        result = dict(
             id=self.id,
             flavor=self.flavor,
-            kv=db.decompress_json(self.kv),
-            snapshot_ids=[s.id for s in self.snapshots],
+            kv=decompress_json(self.kv),
         )
+        if snapshots:
+            result['snapshot_ids'] = [s.id for s in self.snapshots]
+        return result
 
 
 class Snapshot(Model):
@@ -85,13 +94,18 @@ class Snapshot(Model):
 
     id = db.Column(db.Integer, primary_key=True)
 
-    collection_id = db.Column(
-        db.Integer, db.ForeignKey('collections.id', onupdate='CASCADE', ondelete='SET NULL'))
+    # active_history loads the old values of collection_id, utc and tz when
+    # they're set, so habit progress can be moved from the old period to the new.
+    collection_id = db.column_property(db.Column(
+        db.Integer,
+        db.ForeignKey('collections.id', onupdate='CASCADE', ondelete='SET NULL'),
+        index=True), active_history=True)
     collection = db.relationship(
         Collection, backref='snapshots', lazy='selectin', uselist=False)
 
-    utc = db.Column(db.Integer, index=True, nullable=False)
-    tz = db.Column(db.String)
+    utc = db.column_property(
+        db.Column(db.Integer, index=True, nullable=False), active_history=True)
+    tz = db.column_property(db.Column(db.String), active_history=True)
 
     lat = db.Column(db.Float)
     lng = db.Column(db.Float)
@@ -102,7 +116,7 @@ class Snapshot(Model):
         for attr in 'utc tz lat lng collection_id'.split():
             if attr in data:
                 setattr(self, attr, data.pop(attr))
-        self.kv = db.update_json(self.kv, data, Snapshot.STRINGS)
+        self.kv = update_json(self.kv, data, Snapshot.STRINGS)
 
     def to_dict(self):
         return dict(
@@ -112,5 +126,170 @@ class Snapshot(Model):
             lat=self.lat,
             lng=self.lng,
             collection_id=self.collection_id,
-            kv=db.decompress_json(self.kv),
+            kv=decompress_json(self.kv),
         )
+
+
+# full-text search over snapshot notes and collection goals. rowids encode the
+# source row as 2 * id + SEARCH_KINDS.index(kind).
+
+SEARCH_KINDS = ('snapshot', 'collection')
+
+CREATE_SEARCH = '''\
+CREATE VIRTUAL TABLE IF NOT EXISTS search USING fts5(
+  body, utc UNINDEXED, tokenize = 'porter unicode61')'''
+
+db.event.listen(Model.metadata, 'after_create', db.DDL(CREATE_SEARCH))
+
+
+def _search_rowid(kind, id):
+    return 2 * id + SEARCH_KINDS.index(kind)
+
+
+def _index(connection, kind, id, body, utc=None):
+    rowid = _search_rowid(kind, id)
+    connection.execute(
+        db.text('DELETE FROM search WHERE rowid = :rowid'), dict(rowid=rowid))
+    if body:
+        connection.execute(
+            db.text('INSERT INTO search (rowid, body, utc) VALUES (:rowid, :body, :utc)'),
+            dict(rowid=rowid, body=body, utc=utc))
+
+
+def _changed(target, *attrs):
+    state = db.inspect(target)
+    return any(state.attrs[attr].history.has_changes() for attr in attrs)
+
+
+@db.event.listens_for(Snapshot, 'after_insert')
+@db.event.listens_for(Snapshot, 'after_update')
+def _index_snapshot(mapper, connection, target):
+    if _changed(target, 'kv', 'utc'):
+        _index(connection, 'snapshot', target.id,
+               decompress_json(target.kv).get('note'), target.utc)
+
+
+@db.event.listens_for(Collection, 'after_insert')
+@db.event.listens_for(Collection, 'after_update')
+def _index_collection(mapper, connection, target):
+    if _changed(target, 'kv'):
+        _index(connection, 'collection', target.id,
+               decompress_json(target.kv).get('goals'))
+
+
+@db.event.listens_for(Snapshot, 'after_delete')
+def _unindex_snapshot(mapper, connection, target):
+    _index(connection, 'snapshot', target.id, None)
+
+
+@db.event.listens_for(Collection, 'after_delete')
+def _unindex_collection(mapper, connection, target):
+    _index(connection, 'collection', target.id, None)
+
+
+def rebuild_search(connection):
+    connection.execute(db.DDL(CREATE_SEARCH))
+    connection.execute(db.text('DELETE FROM search'))
+    count = 0
+    snapshots = db.select(Snapshot.id, Snapshot.utc, Snapshot.kv)
+    for id, utc, kv in connection.execute(snapshots):
+        note = decompress_json(kv).get('note')
+        if note:
+            _index(connection, 'snapshot', id, note, utc)
+            count += 1
+    for id, kv in connection.execute(db.select(Collection.id, Collection.kv)):
+        goals = decompress_json(kv).get('goals')
+        if goals:
+            _index(connection, 'collection', id, goals)
+            count += 1
+    connection.execute(db.text("INSERT INTO search (search) VALUES ('optimize')"))
+    return count
+
+
+SEARCH_LIMIT = 100
+
+
+# start and end only filter snapshots; collections have no time and always match.
+def search(connection, query, start=None, end=None, limit=20, offset=0):
+    rows = connection.execute(db.text('''\
+SELECT rowid, utc, bm25(search) AS rank, snippet(search, 0, '[', ']', '...', 12)
+FROM search
+WHERE search MATCH :query
+  AND (utc IS NULL OR :start IS NULL OR utc >= :start)
+  AND (utc IS NULL OR :end IS NULL OR utc <= :end)
+ORDER BY rank
+LIMIT :limit OFFSET :offset'''), dict(
+        query=query, start=start, end=end,
+        limit=max(1, min(limit, SEARCH_LIMIT)), offset=max(0, offset)))
+    return [dict(kind=SEARCH_KINDS[rowid % 2], id=rowid // 2, utc=utc,
+                 rank=rank, snippet=snippet)
+            for rowid, utc, rank, snippet in rows]
+
+
+# habit progress: each habit collection keeps per-period snapshot counts in
+# its state column, adjusted as snapshots come and go.
+
+def recompute_habits(connection, cids=None):
+    query = db.select(Collection.id, Collection.kv).where(Collection.flavor == 'habit')
+    if cids is not None:
+        query = query.where(Collection.id.in_(cids))
+    count = 0
+    for cid, kv in connection.execute(query).all():
+        state = habits.initial(habits.parse_goals(decompress_json(kv)))
+        for utc, tz in connection.execute(db.select(Snapshot.utc, Snapshot.tz).where(
+                Snapshot.collection_id == cid).order_by(Snapshot.utc)):
+            habits.add(state, utc, tz)
+        connection.execute(db.update(Collection).where(Collection.id == cid).values(
+            state=compress_json(state)))
+        count += 1
+    return count
+
+
+# returns True if the habit's state was recomputed from the snapshots table,
+# which already reflects the change being counted.
+def _count_habit(connection, cid, utc, tz, delta):
+    if cid is None or utc is None:
+        return False
+    row = connection.execute(db.select(Collection.flavor, Collection.state).where(
+        Collection.id == cid)).first()
+    if not row or row.flavor != 'habit':
+        return False
+    if row.state is None:
+        recompute_habits(connection, [cid])
+        return True
+    state = habits.add(decompress_json(row.state), utc, tz, delta)
+    connection.execute(db.update(Collection).where(Collection.id == cid).values(
+        state=compress_json(state)))
+    return False
+
+
+@db.event.listens_for(Collection, 'after_insert')
+@db.event.listens_for(Collection, 'after_update')
+def _evaluate_habit(mapper, connection, target):
+    if target.flavor == 'habit' and _changed(target, 'kv', 'flavor'):
+        recompute_habits(connection, [target.id])
+
+
+@db.event.listens_for(Snapshot, 'after_insert')
+def _count_inserted_snapshot(mapper, connection, target):
+    _count_habit(connection, target.collection_id, target.utc, target.tz, 1)
+
+
+@db.event.listens_for(Snapshot, 'after_update')
+def _count_updated_snapshot(mapper, connection, target):
+    state = db.inspect(target)
+    history = [state.attrs[attr].history for attr in ('collection_id', 'utc', 'tz')]
+    if not any(h.has_changes() for h in history):
+        return
+    old_cid, old_utc, old_tz = (
+        h.deleted[0] if h.deleted else getattr(target, attr)
+        for h, attr in zip(history, ('collection_id', 'utc', 'tz')))
+    recomputed = _count_habit(connection, old_cid, old_utc, old_tz, -1)
+    if recomputed and old_cid == target.collection_id:
+        return
+    _count_habit(connection, target.collection_id, target.utc, target.tz, 1)
+
+
+@db.event.listens_for(Snapshot, 'after_delete')
+def _count_deleted_snapshot(mapper, connection, target):
+    _count_habit(connection, target.collection_id, target.utc, target.tz, -1)
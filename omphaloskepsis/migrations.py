@@ -0,0 +1,78 @@
+import concurrent.futures
+import glob
+import os
+
+from . import db
+from . import measurements
+
+# Schema migrations for per-account databases. The schema version of each
+# database is kept in PRAGMA user_version; version N means MIGRATIONS[:N] have
+# been applied. Pending migrations run in one BEGIN IMMEDIATE transaction, so
+# concurrent openers of the same database apply them exactly once, and a
+# failure leaves the database at its old version.
+
+def _create_search(conn):
+    measurements.rebuild_search(conn)
+
+def _index_snapshot_collections(conn):
+    conn.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_snapshots_collection_id '
+                         'ON snapshots (collection_id)')
+
+def _add_habit_state(conn):
+    columns = {row[1] for row in conn.exec_driver_sql('PRAGMA table_info(collections)')}
+    if 'state' not in columns:
+        conn.exec_driver_sql('ALTER TABLE collections ADD COLUMN state BLOB')
+    measurements.recompute_habits(conn)
+
+MIGRATIONS = [
+    _create_search,
+    _index_snapshot_collections,
+    _add_habit_state,
+]
+
+LATEST = len(MIGRATIONS)
+
+
+def version(conn):
+    return conn.exec_driver_sql('PRAGMA user_version').scalar()
+
+
+def stamp(conn, v=LATEST):
+    conn.exec_driver_sql(f'PRAGMA user_version = {int(v)}')
+
+
+def upgrade(engine):
+    with engine.connect() as conn:
+        before = version(conn)
+        if before >= LATEST:
+            return before, before
+        # the explicit BEGIN also keeps pysqlite from committing around DDL.
+        conn.exec_driver_sql('BEGIN IMMEDIATE')
+        current = version(conn)
+        for v in range(current, LATEST):
+            MIGRATIONS[v](conn)
+        stamp(conn, LATEST)
+        conn.commit()
+    return before, LATEST
+
+
+def _upgrade_path(path):
+    engine = db.engine(path)
+    try:
+        return upgrade(engine)
+    finally:
+        engine.dispose()
+
+
+def shards(root):
+    return sorted(glob.glob(os.path.join(root, '*', '*', '*.db')))
+
+
+# Yields (path, (before, after), error) as each database finishes; at most
+# `workers` databases are upgraded at once.
+def upgrade_all(paths, workers=None):
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(_upgrade_path, path): path for path in paths}
+        for future in concurrent.futures.as_completed(futures):
+            error = future.exception()
+            yield futures[future], None if error else future.result(), error
@@ -0,0 +1,184 @@
+import collections
+import email.message
+import logging
+import smtplib
+import threading
+import time
+
+import sqlalchemy
+
+from . import accounts
+from . import db
+
+BATCH = 50
+MAX_ATTEMPTS = 8
+BACKOFF_SECONDS = 60
+LEASE_SECONDS = 300
+
+stats = collections.Counter()
+
+log = logging.getLogger(__name__)
+
+
+def create_table(db_path):
+    accounts.Outbox.__table__.create(db.engine(db_path), checkfirst=True)
+
+
+def enqueue(sess, sender, recipients, subject, body):
+    message = accounts.Outbox(
+        sender=sender, recipients=','.join(recipients), subject=subject, body=body)
+    sess.add(message)
+    return message
+
+
+def compose(message):
+    msg = email.message.EmailMessage()
+    msg['From'] = message.sender
+    msg['To'] = message.recipients
+    msg['Subject'] = message.subject
+    msg.set_content(message.body)
+    return msg
+
+
+# an SMTP connection that is opened on demand and reused across sends.
+class Connection:
+
+    def __init__(self, host='localhost', port=25, use_tls=False,
+                 username=None, password=None, timeout=30):
+        self.host = host
+        self.port = port
+        self.use_tls = use_tls
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        self._smtp = None
+
+    def _open(self):
+        smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        if self.use_tls:
+            smtp.starttls()
+        if self.username:
+            smtp.login(self.username, self.password)
+        self._smtp = smtp
+        stats['connections'] += 1
+
+    def send(self, msg):
+        if self._smtp is None:
+            self._open()
+        try:
+            self._smtp.send_message(msg)
+        except smtplib.SMTPServerDisconnected:
+            # the server dropped our idle connection; reconnect and retry once.
+            self._open()
+            self._smtp.send_message(msg)
+
+    def close(self):
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except (OSError, smtplib.SMTPException):
+                pass
+            self._smtp = None
+
+
+def _claim(sess, now, limit):
+    # leasing rows by bumping send_after_utc keeps concurrent senders from
+    # delivering the same message twice.
+    Outbox = accounts.Outbox
+    due = sess.execute(sqlalchemy.select(Outbox.id, Outbox.send_after_utc).where(
+        Outbox.sent_utc < 0,
+        Outbox.attempts < MAX_ATTEMPTS,
+        Outbox.send_after_utc <= now,
+    ).order_by(Outbox.send_after_utc).limit(limit)).all()
+    claimed = []
+    for id, send_after_utc in due:
+        res = sess.execute(sqlalchemy.update(Outbox).where(
+            Outbox.id == id, Outbox.send_after_utc == send_after_utc,
+        ).values(send_after_utc=now + LEASE_SECONDS))
+        if res.rowcount:
+            claimed.append(id)
+    sess.commit()
+    return claimed
+
+
+def deliver(sess, connection, limit=BATCH):
+    now = time.time()
+    ids = _claim(sess, now, limit)
+    for id in ids:
+        message = sess.get(accounts.Outbox, id)
+        try:
+            msg = compose(message)
+        except Exception as e:
+            # a malformed message will never send, so don't retry it.
+            _failed(message, e, now, MAX_ATTEMPTS)
+        else:
+            try:
+                connection.send(msg)
+            except Exception as e:
+                _failed(message, e, now, message.attempts + 1)
+                connection.close()
+            else:
+                message.sent_utc = now
+                stats['sent'] += 1
+        sess.commit()
+    if ids:
+        log.info('outbox: %s', ', '.join(f'{k}={v}' for k, v in sorted(stats.items())))
+    return len(ids)
+
+
+def _failed(message, error, now, attempts):
+    message.attempts = attempts
+    message.last_error = repr(error)[:500]
+    message.send_after_utc = now + BACKOFF_SECONDS * 2 ** (attempts - 1)
+    stats['failed'] += 1
+    if attempts >= MAX_ATTEMPTS:
+        stats['abandoned'] += 1
+        log.warning('outbox: abandoning message %s: %s', message.id, message.last_error)
+
+
+def summary(sess):
+    Outbox = accounts.Outbox
+    count = lambda *where: sess.scalar(
+        sqlalchemy.select(sqlalchemy.func.count(Outbox.id)).where(*where))
+    return dict(
+        pending=count(Outbox.sent_utc < 0, Outbox.attempts < MAX_ATTEMPTS),
+        retrying=count(
+            Outbox.sent_utc < 0, Outbox.attempts.between(1, MAX_ATTEMPTS - 1)),
+        abandoned=count(Outbox.sent_utc < 0, Outbox.attempts >= MAX_ATTEMPTS),
+        sent=count(Outbox.sent_utc >= 0),
+        failed_attempts=sess.scalar(
+            sqlalchemy.select(sqlalchemy.func.coalesce(sqlalchemy.func.sum(
+                Outbox.attempts), 0))),
+    )
+
+
+def run(sessionmaker, connection, interval=5, stop=None):
+    stop = stop or threading.Event()
+    while not stop.is_set():
+        sess = sessionmaker()
+        try:
+            count = deliver(sess, connection)
+        except Exception:
+            # keep the sender alive; claimed messages are retried once their
+            # lease expires.
+            log.exception('outbox: delivery failed')
+            count = 0
+            stats['errors'] += 1
+            connection.close()
+        finally:
+            sess.close()
+        if count < BATCH:
+            connection.close()
+            stop.wait(interval)
+    connection.close()
+
+
+def start(db_path, connection, interval=5):
+    create_table(db_path)
+    stop = threading.Event()
+    sessionmaker = db.sessionmaker(bind=db.engine(db_path), autoflush=False)
+    thread = threading.Thread(
+        target=run, args=(sessionmaker, connection, interval, stop),
+        name='outbox', daemon=True)
+    thread.start()
+    return thread, stop
@@ -1,14 +1,15 @@
+import base64
 import collections
 import flask
 import flask_bcrypt
 import flask_limiter as flim
-import flask_mail
 import flask_sessions
 import flask_sqlalchemy
 import hashlib
 import jinja2
 import json
 import os
+import re
 import secrets
 import sqlalchemy
 import time
@@ -17,6 +18,10 @@ import yaml
 import werkzeug.middleware.proxy_fix as pfix
 
 from . import accounts
+from . import db
+from . import formats
+from . import outbox
+from . import measurements
 from .measurements import Collection, Profile, Snapshot
 
 app = flask.Flask('omphaloskepsis', template_folder='static')
@@ -24,7 +29,6 @@ app.wsgi_app = pfix.ProxyFix(app.wsgi_app, x_for=1)
 
 gdb = flask_sqlalchemy.SQLAlchemy()
 bcrypt = flask_bcrypt.Bcrypt(app)
-mail = flask_mail.Mail(app)
 limiter = flim.Limiter(
     flim.util.get_remote_address, app=app, storage_uri='redis://127.0.0.1:6379')
 
@@ -35,11 +39,26 @@ def _create_csrf_token(s):
     return hashlib.sha256(f'{time.time()}{s}'.encode('utf8')).hexdigest()
 
 
+def _accepted():
+    return formats.negotiate(flask.request.accept_mimetypes)
+
+
+def _respond(data):
+    mimetype = _accepted()
+    if mimetype == formats.JSON:
+        resp = flask.jsonify(data)
+    else:
+        resp = flask.Response(formats.render(data, mimetype), mimetype=mimetype)
+    resp.vary.add('Accept')
+    return resp
+
+
 def _json(items):
     try:
-        return flask.jsonify([item.to_dict() for item in items])
+        data = [item.to_dict() for item in items]
     except:
-        return flask.jsonify(items.to_dict())
+        data = items.to_dict()
+    return _respond(data)
 
 
 @app.before_request
@@ -47,21 +66,28 @@ def _populate_account():
     req = flask.request
     req.sess = None
     if 'aid' in flask.session:
-        if acct:
-            # open account-specific database
-            req.session = db.sessionmaker(
-                bind=db.engine(
-                    accounts.db_path(app.config['root']),
-                    app.config['SQLALCHEMY_ECHO'],
+        aid = flask.session['aid']
+        if os.path.exists(accounts.path(app.config['root'], aid)):
+            # open account-specific database, migrating it if needed
+            req.sess = db.sessionmaker(
+                bind=accounts.engine(
+                    app.config['root'], aid, app.config['SQLALCHEMY_ECHO'],
                 ), autoflush=False
             )()
         else:
           del flask.session['aid']
 
 
+@app.teardown_request
+def _close_account(exc):
+    sess = getattr(flask.request, 'sess', None)
+    if sess is not None:
+        sess.close()
+
+
 @app.before_request
 def _is_api_request_ok():
-    if flask.request.path.startswith('/api/login'):
+    if flask.request.path.startswith(('/api/login', '/api/register')):
         return
     if flask.request.path.startswith('/api/') and 'aid' not in flask.session:
         flask.abort(401)
@@ -88,31 +114,39 @@ def get_dashboard():
 
 @app.route('/api/habits/', methods=['GET'])
 def get_habits():
-    sess = flask.request.acct.session
-    return _json(sess.scalars(
-        sqlalchemy.select(Collection).where(Collection.flavor == 'habit')))
+    now = time.time()
+    return _respond([
+        dict(c.to_dict(snapshots=False), progress=c.habit_progress(now))
+        for c in flask.request.sess.scalars(
+            sqlalchemy.select(Collection).where(Collection.flavor == 'habit'))
+    ])
 
 @app.route('/api/timeline/', methods=['GET'])
 def get_timeline():
     req = flask.request
     now = time.time()
     get = lambda key, days: req.args.get(key, now + 86400 * days)
-    result = {}
-    result['snapshots'] = {
-        s.id: s.to_dict() for s in
+    snapshots = [
+        s.to_dict() for s in
         req.sess.scalars(sqlalchemy.select(Snapshot).where(
             Snapshot.utc >= get('start', -90),
             Snapshot.utc <= get('end', 0),
         ))
-    }
-    cids = {s.get('collection_id') for s in result['snapshots'].values()}
-    result['collections'] = {
-        c.id: c.to_dict() for c in
+    ]
+    cids = {s.get('collection_id') for s in snapshots}
+    colls = [
+        c.to_dict() for c in
         req.sess.scalars(sqlalchemy.select(Collection).where(
             Collection.id.in_(cids),
         ))
-    }
-    return flask.jsonify(result)
+    ]
+    # columnar formats carry ids in their own column, so they get plain lists.
+    if _accepted() == formats.JSON:
+        return _respond(dict(
+            snapshots={s['id']: s for s in snapshots},
+            collections={c['id']: c for c in colls},
+        ))
+    return _respond(dict(snapshots=snapshots, collections=colls))
 
 @app.route('/api/workouts/', methods=['GET'])
 def get_workouts():
@@ -177,12 +211,13 @@ def create_collection():
 
 @app.route('/api/collection/<int:cid>/', methods=['GET'])
 def get_collection(cid):
-    sess = flask.request.acct.session
+    sess = flask.request.sess
     collection = sess.get(Collection, cid)
-    snapshots = sess.scalars(sqlalchemy.select(Snapshot).where(Snapshot.collection_id == cid))
+    snapshots = sess.scalars(
+        sqlalchemy.select(Snapshot).where(Snapshot.collection_id == cid))
     if not collection:
         flask.abort(403)
-    return flask.jsonify(dict(
+    return _respond(dict(
         collection=collection.to_dict(),
         snapshots=[s.to_dict() for s in snapshots],
     ))
@@ -194,12 +229,13 @@ def update_collection(cid):
     if not collection:
         flask.abort(403)
     collection.update_from(req.json)
-    sess.commit()
+    req.sess.commit()
     return _json(collection)
 
 @app.route('/api/collection/<int:cid>/', methods=['DELETE'])
 def delete_collection(cid):
-    collection = flask.request..get(Collection, cid)
+    sess = flask.request.sess
+    collection = sess.get(Collection, cid)
     if not collection:
         flask.abort(403)
     sess.delete(collection)
@@ -227,6 +263,41 @@ def update_profile():
     return _json(profile)
 
 
+# search
+
+@app.route('/api/search/', methods=['GET'])
+def search():
+    req = flask.request
+    query = req.args.get('q', '').strip()
+    if not query:
+        flask.abort(400)
+    try:
+        hits = measurements.search(
+            req.sess.connection(), query,
+            start=req.args.get('start', type=float),
+            end=req.args.get('end', type=float),
+            limit=req.args.get('limit', 20, type=int),
+            offset=req.args.get('offset', 0, type=int),
+        )
+    except sqlalchemy.exc.OperationalError:
+        flask.abort(400)
+    return _respond(hits)
+
+
+# export
+
+@app.route('/api/export/', methods=['GET'])
+def export():
+    sess = flask.request.sess
+    return _respond(dict(
+        profile=[p.to_dict() for p in sess.scalars(sqlalchemy.select(Profile))],
+        collections=[c.to_dict() for c in sess.scalars(
+            sqlalchemy.select(Collection).order_by(Collection.id))],
+        snapshots=[s.to_dict() for s in sess.scalars(
+            sqlalchemy.select(Snapshot).order_by(Snapshot.utc))],
+    ))
+
+
 # account
 
 @app.route('/api/account/', methods=['GET'])
@@ -249,6 +320,8 @@ def delete_account():
 
 # signup
 
+EMAIL = re.compile(r'[^@\s,]+@[^@\s,]+\.[^@\s,]+')
+
 SIGNUP_EMAIL_BODY = '''\
 Hello {email} -
 
@@ -270,9 +343,27 @@ def register():
         flask.abort(401)
 
     email = req.json['email']
+    if not isinstance(email, str) or not EMAIL.fullmatch(email) or len(email) > 80:
+        flask.abort(400)
+    password = req.json.get('password')
+    if not isinstance(password, str):
+        flask.abort(400)
+    if not accounts.Password().is_valid_password(password):
+        flask.abort(400)
+    if gdb.session.scalar(sqlalchemy.select(accounts.Email).where(
+            accounts.Email.email == email)):
+        flask.abort(409)
     code = secrets.token_hex()
     domain = app.config['SESSION_COOKIE_DOMAIN']
-    mail.send(flask_mail.Message(
+
+    account = accounts.Account()
+    account.emails.append(accounts.Email(email=email, validation_code=code))
+    account.passwords.append(accounts.Password(
+        password=bcrypt.generate_password_hash(password)))
+
+    gdb.session.add(account)
+    outbox.enqueue(
+        gdb.session,
         sender=f'noreply@{domain}',
         recipients=[email],
         subject='Please confirm your email address',
@@ -280,19 +371,14 @@ def register():
             code=code,
             domain=domain,
             email=email,
-            email64=base64.urlsafe_b64encode(email.encode('utf8')).strip(b'='),
-        )))
-
-    account = accounts.Account()
-    account.emails.append(accounts.Email(email=email, validation_code=code))
-    account.passwords.append(accounts.Password(password=req.json.get('password')))
-
-    gdb.session.add(account)
+            email64=base64.urlsafe_b64encode(
+                email.encode('utf8')).strip(b'=').decode('utf8'),
+        ))
     gdb.session.commit()
 
-    account.create_db(app.config['root'])
+    accounts.create(app.config['root'], account.id)
 
-    return _json({})
+    return _respond({})
 
 
 # session
@@ -355,7 +441,7 @@ def index(path=''):
 
 
 def create_app(db, debug=False, secret=None, domain='localhost',
-               config_path=None, assets=None):
+               config_path=None, assets=None, memory_mb=256, storage_profile='hot'):
 
     app.config['SECRET_KEY'] = secret or secrets.token_hex(128)
 
@@ -377,6 +463,8 @@ def create_app(db, debug=False, secret=None, domain='localhost',
 
     app.config['config'] = config_path
     app.config['root'] = os.path.dirname(db)
+    outbox.create_table(db)
+    accounts.budget.resize(memory_mb << 20, storage_profile)
 
     if assets is not None:
         app.static_folder = assets
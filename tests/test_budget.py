@@ -0,0 +1,63 @@
+from omphaloskepsis import db
+
+
+def _pragmas(conn):
+    return tuple(conn.exec_driver_sql(f'PRAGMA {p}').scalar()
+                 for p in ('cache_size', 'mmap_size'))
+
+
+def _raw(conn):
+    return conn.connection.dbapi_connection
+
+
+def test_hot_engines_keep_their_connections(tmp_path):
+    budget = db.Budget(total_bytes=128 << 20, profile='hot', min_bytes=1 << 20, hot=2)
+    first = budget.engine(str(tmp_path / 'first.db'))
+    with first.connect() as conn:
+        assert _pragmas(conn) == (-16384, 48 << 20)
+        raw = _raw(conn)
+    second = budget.engine(str(tmp_path / 'second.db'))
+    with second.connect():
+        pass
+    for i in range(14):
+        budget.engine(str(tmp_path / 'first.db'))
+        with budget.engine(str(tmp_path / f'{i}.db')).connect():
+            pass
+
+    # first stayed hot on a smaller share; second went cold and was closed.
+    assert first.pool.checkedin() == 1
+    with first.connect() as conn:
+        assert _raw(conn) is raw
+        assert _pragmas(conn) == (-16384, 25 << 19)
+    assert second.pool.checkedin() == 0
+    with second.connect() as conn:
+        assert _pragmas(conn) == (-512, 0)
+    with budget.engine(str(tmp_path / '13.db')).connect() as conn:
+        assert _pragmas(conn) == (-16384, 25 << 19)
+
+
+def test_profile_change_reopens_connections(tmp_path):
+    budget = db.Budget(total_bytes=64 << 20, profile='hot')
+    eng = budget.engine(str(tmp_path / 'a.db'))
+    statements = []
+    db.event.listen(eng, 'do_connect', lambda dialect, rec, cargs, cparams:
+                    statements.append(cparams['cached_statements']))
+    with eng.connect():
+        pass
+    budget.resize(profile='warm')
+    assert eng.pool.checkedin() == 0
+    with eng.connect() as conn:
+        assert _pragmas(conn) == (-4096, 0)
+    assert statements == [128, 64]
+
+
+def test_evicts_coldest_engines_below_min_bytes(tmp_path):
+    budget = db.Budget(total_bytes=4 << 20, profile='hot', min_bytes=1 << 20, hot=1)
+    paths = [str(tmp_path / f'{i}.db') for i in range(6)]
+    for p in paths:
+        budget.engine(p)
+    budget.engine(paths[2])
+    budget.engine(paths[5])
+    assert list(budget._engines) == paths[3:5] + [paths[2], paths[5]]
+    assert set(budget._settings) == set(paths[2:])
+    assert budget._hot == {paths[5]}
@@ -0,0 +1,72 @@
+import array
+import json
+import math
+
+import pytest
+
+from omphaloskepsis import formats
+
+ROWS = [
+    dict(id=1, utc=100, lat=1.5, kv=dict(hr=60, note='ran')),
+    dict(id=2, utc=200, lat=None, kv=dict(done=True)),
+]
+
+
+def test_columnar_splits_rows_and_kv():
+    assert formats.columnar(dict(snapshots=ROWS, other=[1, 2])) == dict(
+        snapshots=dict(
+            id=[1, 2],
+            lat=[1.5, None],
+            utc=[100, 200],
+            kv=dict(done=[None, True], hr=[60, None], note=['ran', None]),
+        ),
+        other=[1, 2],
+    )
+    assert formats.columnar([]) == []
+
+
+def test_columns_json():
+    cols = json.loads(formats.render(ROWS, formats.COLUMNS))
+    assert cols['id'] == [1, 2]
+    assert cols['kv']['hr'] == [60, None]
+
+
+def test_typed_ints():
+    code, buf = formats._typed([1, -2, 2 ** 62])
+    assert code == formats.INT64
+    assert buf.tolist() == [1, -2, 2 ** 62]
+
+
+def test_typed_floats_with_gaps():
+    for values in ([1.5, None, 2], [60, None]):
+        code, buf = formats._typed(values)
+        assert code == formats.FLOAT64
+        assert buf[0] == values[0] and math.isnan(buf[1])
+
+
+def test_typed_rejects_lossy_and_non_numeric_columns():
+    assert formats._typed([2 ** 60, None]) is None
+    assert formats._typed([2 ** 60, 1.5]) is None
+    assert formats._typed([2 ** 64, 1]) is None
+    assert formats._typed([True, 1]) is None
+    assert formats._typed(['a', 1]) is None
+    assert formats._typed([None, None]) is None
+    assert formats._typed([]) is None
+
+
+def test_msgpack_round_trip():
+    msgpack = pytest.importorskip('msgpack')
+
+    def ext(code, data):
+        values = array.array({formats.INT64: 'q', formats.FLOAT64: 'd'}[code])
+        values.frombytes(data)
+        return values.tolist()
+
+    cols = msgpack.unpackb(
+        formats.render(dict(snapshots=ROWS), formats.MSGPACK), ext_hook=ext)['snapshots']
+    assert cols['id'] == [1, 2]
+    assert cols['utc'] == [100, 200]
+    assert cols['lat'][0] == 1.5 and math.isnan(cols['lat'][1])
+    assert cols['kv']['hr'][0] == 60.0 and math.isnan(cols['kv']['hr'][1])
+    assert cols['kv']['done'] == [None, True]
+    assert cols['kv']['note'] == ['ran', None]
@@ -0,0 +1,102 @@
+import datetime
+
+import pytest
+
+from omphaloskepsis import db, habits, measurements
+
+NY = 'America/New_York'
+
+
+def _utc(*args, tz=NY):
+    return datetime.datetime(*args, tzinfo=habits._zone(tz)).timestamp()
+
+
+@pytest.fixture
+def sess():
+    engine = db.engine(':memory:')
+    measurements.Model.metadata.create_all(engine)
+    return db.sessionmaker(bind=engine, autoflush=False)()
+
+
+def _habit(sess, goals):
+    habit = measurements.Collection()
+    habit.update_from(dict(flavor='habit', goals=goals))
+    sess.add(habit)
+    sess.commit()
+    return habit
+
+
+def _state(habit):
+    return measurements.decompress_json(habit.state)
+
+
+def test_parse_goals():
+    assert habits.parse_goals(dict(goals='2 per 3 days, 1x/week')) == [
+        [2, 3, 'day'], [1, 1, 'week']]
+    assert habits.parse_goals(dict(goal=2, perSeconds=3 * 86400)) == [[2, 3, 'day']]
+    assert habits.parse_goals(dict(goals='whenever')) == []
+    assert habits.parse_goals(dict(goal=True, perSeconds=86400)) == []
+    assert habits.parse_goals(dict(goal=1, perSeconds=False)) == []
+
+
+def test_days_follow_the_local_calendar():
+    state = habits.initial([[1, 1, 'day']])
+    # 6pm and 8pm local on consecutive days are UTC days d and d + 2.
+    habits.add(state, _utc(2024, 3, 4, 18), NY)
+    habits.add(state, _utc(2024, 3, 5, 20), NY)
+    [progress] = habits.summarize(state, _utc(2024, 3, 5, 21))
+    assert progress['current_streak'] == 2
+    assert progress['completed_periods'] == progress['total_periods'] == 2
+
+
+def test_unfinished_period_is_not_a_miss():
+    state = habits.initial([[1, 1, 'day']])
+    habits.add(state, _utc(2024, 3, 1, 9), NY)
+    habits.add(state, _utc(2024, 3, 3, 9), NY)
+    [progress] = habits.summarize(state, _utc(2024, 3, 4, 8))
+    assert progress['total_periods'] == 3
+    assert progress['completion_rate'] == 2 / 3
+    assert progress['current_streak'] == 1
+
+    habits.add(state, _utc(2024, 3, 4, 9), NY)
+    [progress] = habits.summarize(state, _utc(2024, 3, 4, 10))
+    assert progress['total_periods'] == 4
+    assert progress['completion_rate'] == 3 / 4
+
+
+def test_weeks_start_on_monday():
+    sunday, monday = _utc(2024, 3, 10, 12), _utc(2024, 3, 11, 12)
+    assert habits.period_key(sunday, NY, 1, 'week') + 1 == \
+        habits.period_key(monday, NY, 1, 'week')
+
+
+def test_incremental_state_matches_recompute(sess):
+    habit = _habit(sess, '1 per day, 3 per week')
+    other = _habit(sess, '1 per day')
+    snapshots = [measurements.Snapshot(
+        collection_id=habit.id, utc=_utc(2024, 3, d, 9), tz=NY) for d in range(1, 11)]
+    sess.add_all(snapshots)
+    sess.commit()
+    sess.delete(snapshots[3])
+    snapshots[0].utc = _utc(2024, 3, 12, 9)
+    snapshots[1].collection_id = other.id
+    snapshots[2].tz = 'Asia/Tokyo'
+    sess.commit()
+
+    incremental = _state(habit), _state(other)
+    measurements.recompute_habits(sess.connection())
+    sess.commit()
+    assert (_state(habit), _state(other)) == incremental
+
+
+def test_update_with_missing_state_counts_once(sess):
+    habit = _habit(sess, '1 per day')
+    snapshot = measurements.Snapshot(
+        collection_id=habit.id, utc=_utc(2024, 3, 1, 9), tz=NY)
+    sess.add(snapshot)
+    sess.commit()
+    sess.execute(db.update(measurements.Collection).values(state=None))
+    sess.commit()
+    snapshot.utc = _utc(2024, 3, 2, 9)
+    sess.commit()
+    assert sum(_state(habit)['periods'][0].values()) == 1
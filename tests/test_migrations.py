@@ -0,0 +1,124 @@
+import os
+import sqlite3
+import threading
+import zlib
+
+import pytest
+
+from omphaloskepsis import accounts, db, migrations
+
+BASELINE = '''
+CREATE TABLE profiles (id INTEGER PRIMARY KEY, kv BLOB);
+CREATE TABLE collections (id INTEGER PRIMARY KEY, flavor VARCHAR NOT NULL, kv BLOB);
+CREATE TABLE snapshots (
+    id INTEGER PRIMARY KEY, collection_id INTEGER, utc INTEGER NOT NULL,
+    tz VARCHAR, lat FLOAT, lng FLOAT, kv BLOB);
+INSERT INTO collections VALUES (1, 'habit', X'{goals}');
+INSERT INTO snapshots (collection_id, utc, kv) VALUES (1, 86400, X'{note}');
+'''
+
+
+def _baseline(root, x):
+    p = accounts.path(root, x)
+    os.makedirs(os.path.dirname(p), exist_ok=True)
+    conn = sqlite3.connect(p)
+    conn.executescript(BASELINE.format(
+        goals=zlib.compress(b'{"goals": "1 per day"}').hex(),
+        note=zlib.compress(b'{"note": "legacy note"}').hex()))
+    conn.close()
+    return p
+
+
+def _inspect(p):
+    conn = sqlite3.connect(p)
+    try:
+        return dict(
+            version=conn.execute('PRAGMA user_version').fetchone()[0],
+            columns={r[1] for r in conn.execute('PRAGMA table_info(collections)')},
+            tables={r[0] for r in conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table'")},
+        )
+    finally:
+        conn.close()
+
+
+def test_upgrades_baseline_databases(tmp_path):
+    p = _baseline(str(tmp_path), 1)
+    engine = db.engine(p)
+    assert migrations.upgrade(engine) == (0, migrations.LATEST)
+    assert migrations.upgrade(engine) == (migrations.LATEST, migrations.LATEST)
+    engine.dispose()
+    found = _inspect(p)
+    assert found['version'] == migrations.LATEST
+    assert 'state' in found['columns']
+    assert 'search' in found['tables']
+    conn = sqlite3.connect(p)
+    assert conn.execute("SELECT rowid FROM search WHERE search MATCH 'legacy'").fetchall()
+    assert conn.execute('SELECT state FROM collections').fetchone()[0] is not None
+    conn.close()
+
+
+def test_new_databases_start_current(tmp_path):
+    accounts.create(str(tmp_path), 2)
+    assert _inspect(accounts.path(str(tmp_path), 2))['version'] == migrations.LATEST
+
+
+def test_failed_migrations_roll_back(tmp_path, monkeypatch):
+    p = _baseline(str(tmp_path), 3)
+
+    def broken(conn):
+        conn.exec_driver_sql('CREATE TABLE scratch (x INTEGER)')
+        raise RuntimeError('boom')
+
+    monkeypatch.setattr(migrations, 'MIGRATIONS', migrations.MIGRATIONS + [broken])
+    monkeypatch.setattr(migrations, 'LATEST', migrations.LATEST + 1)
+    engine = db.engine(p)
+    with pytest.raises(RuntimeError):
+        migrations.upgrade(engine)
+    engine.dispose()
+    found = _inspect(p)
+    assert found['version'] == 0
+    assert 'state' not in found['columns']
+    assert 'search' not in found['tables']
+    assert 'scratch' not in found['tables']
+
+
+def test_concurrent_upgrades_apply_once(tmp_path):
+    p = _baseline(str(tmp_path), 4)
+    results, errors = [], []
+
+    def upgrade():
+        engine = db.engine(p)
+        try:
+            results.append(migrations.upgrade(engine))
+        except Exception as e:
+            errors.append(e)
+        finally:
+            engine.dispose()
+
+    threads = [threading.Thread(target=upgrade) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == []
+    assert _inspect(p)['version'] == migrations.LATEST
+
+
+def test_upgrade_all_reports_each_shard(tmp_path):
+    root = str(tmp_path)
+    legacy = _baseline(root, 5)
+    accounts.create(root, 6)
+    current = accounts.path(root, 6)
+    corrupt = os.path.join(root, 'x', 'y', 'corrupt.db')
+    os.makedirs(os.path.dirname(corrupt))
+    with open(corrupt, 'w') as handle:
+        handle.write('not a database' * 100)
+
+    assert migrations.shards(root) == sorted([legacy, current, corrupt])
+    results = {p: (r, e) for p, r, e in migrations.upgrade_all(
+        migrations.shards(root), workers=2)}
+    assert results[legacy] == ((0, migrations.LATEST), None)
+    assert results[current] == ((migrations.LATEST, migrations.LATEST), None)
+    assert results[corrupt][0] is None
+    assert 'not a database' in str(results[corrupt][1])
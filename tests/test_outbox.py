@@ -0,0 +1,138 @@
+import socketserver
+import threading
+import time
+import types
+
+import pytest
+
+from omphaloskepsis import accounts, db, outbox
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        server = self.server
+        server.connections += 1
+        reply = lambda s: self.wfile.write(s.encode('utf8') + b'\r\n')
+        reply('220 ready')
+        while True:
+            line = self.rfile.readline().decode('utf8').strip()
+            cmd = line[:4].upper()
+            if not line or cmd == 'QUIT':
+                reply('221 bye')
+                return
+            if cmd == 'RCPT' and any(r in line for r in server.reject):
+                reply('550 no such user')
+            elif cmd == 'DATA':
+                reply('354 go ahead')
+                while self.rfile.readline() != b'.\r\n':
+                    pass
+                server.delivered += 1
+                reply('250 ok')
+            else:
+                reply('250 ok')
+
+
+@pytest.fixture
+def smtp():
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), SMTPHandler)
+    server.daemon_threads = True
+    server.connections = server.delivered = 0
+    server.reject = ()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def sess(tmp_path):
+    outbox.stats.clear()
+    path = str(tmp_path / 'accounts.db')
+    outbox.create_table(path)
+    return db.sessionmaker(bind=db.engine(path), autoflush=False)()
+
+
+def _enqueue(sess, *recipients):
+    for r in recipients:
+        outbox.enqueue(sess, 'noreply@example.com', [r], 'hello', 'body')
+    sess.commit()
+
+
+def _connection(smtp):
+    return outbox.Connection('127.0.0.1', smtp.server_address[1], timeout=5)
+
+
+def test_delivers_in_batches_over_one_connection(sess, smtp):
+    _enqueue(sess, *(f'u{i}@example.com' for i in range(5)))
+    connection = _connection(smtp)
+    assert outbox.deliver(sess, connection, limit=2) == 2
+    assert outbox.deliver(sess, connection, limit=2) == 2
+    assert outbox.deliver(sess, connection, limit=2) == 1
+    assert outbox.deliver(sess, connection, limit=2) == 0
+    connection.close()
+    assert smtp.delivered == 5
+    assert smtp.connections == 1
+    assert outbox.summary(sess)['sent'] == 5
+
+
+def test_retries_rejected_messages_with_backoff(sess, smtp, monkeypatch):
+    smtp.reject = ('bad@',)
+    _enqueue(sess, 'bad@example.com', 'good@example.com')
+    now = time.time()
+    monkeypatch.setattr(outbox, 'time', types.SimpleNamespace(time=lambda: now))
+    connection = _connection(smtp)
+    assert outbox.deliver(sess, connection) == 2
+    bad = sess.scalar(db.select(accounts.Outbox).where(accounts.Outbox.attempts > 0))
+    assert bad.recipients == 'bad@example.com'
+    assert bad.send_after_utc == now + outbox.BACKOFF_SECONDS
+    assert outbox.deliver(sess, connection) == 0
+
+    now += outbox.BACKOFF_SECONDS
+    assert outbox.deliver(sess, connection) == 1
+    sess.refresh(bad)
+    assert bad.attempts == 2
+    assert bad.send_after_utc == now + 2 * outbox.BACKOFF_SECONDS
+    connection.close()
+    assert smtp.delivered == 1
+    assert outbox.summary(sess)['retrying'] == 1
+
+
+def test_abandons_malformed_messages_without_stopping(sess, smtp):
+    _enqueue(sess, 'evil@example.com\nBcc: x@example.com', 'good@example.com')
+    connection = _connection(smtp)
+    assert outbox.deliver(sess, connection) == 2
+    connection.close()
+    assert smtp.delivered == 1
+    assert outbox.summary(sess)['abandoned'] == 1
+    assert outbox.stats['abandoned'] == 1
+
+
+def test_reclaims_messages_after_lease_expires(sess, smtp, monkeypatch):
+    _enqueue(sess, 'a@example.com')
+    now = time.time()
+    monkeypatch.setattr(outbox, 'time', types.SimpleNamespace(time=lambda: now))
+    # a sender that claims the message and dies before sending it.
+    assert len(outbox._claim(sess, now, outbox.BATCH)) == 1
+    connection = _connection(smtp)
+    assert outbox.deliver(sess, connection) == 0
+    now += outbox.LEASE_SECONDS
+    assert outbox.deliver(sess, connection) == 1
+    connection.close()
+    assert smtp.delivered == 1
+
+
+def test_run_survives_delivery_errors(sess, smtp, monkeypatch):
+    stop = threading.Event()
+    calls = []
+
+    def deliver(sess, connection):
+        calls.append(1)
+        if len(calls) == 1:
+            raise RuntimeError('boom')
+        stop.set()
+        return 0
+
+    monkeypatch.setattr(outbox, 'deliver', deliver)
+    outbox.run(lambda: sess, _connection(smtp), interval=0, stop=stop)
+    assert len(calls) == 2
+    assert outbox.stats['errors'] == 1
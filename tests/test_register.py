@@ -0,0 +1,67 @@
+import os
+
+import flask
+import pytest
+import sqlalchemy
+
+from omphaloskepsis import accounts, db, migrations, outbox, serve
+
+
+@pytest.fixture(scope='module')
+def root(tmp_path_factory):
+    return str(tmp_path_factory.mktemp('accounts'))
+
+
+# the flask app is module-global, so it is configured once for all tests here.
+@pytest.fixture(scope='module')
+def client(root):
+    path = os.path.join(root, 'accounts.db')
+    accounts.Model.metadata.create_all(db.engine(path))
+    app = serve.create_app(path, secret='test', domain='localhost')
+    # keep sessions in signed cookies instead of redis.
+    app.session_interface = flask.sessions.SecureCookieSessionInterface()
+    app.config['RATELIMIT_ENABLED'] = False
+    client = app.test_client()
+    with client.session_transaction(base_url='https://localhost') as session:
+        session['csrf'] = 'token'
+    yield client
+    with app.app_context():
+        serve.gdb.session.remove()
+
+
+def _register(client, **data):
+    return client.post('/api/register/', json=data, base_url='https://localhost',
+                       headers={'x-omphaloskepsis-csrf': 'token'})
+
+
+def test_register_creates_account_and_queues_email(client, root):
+    resp = _register(client, email='new@example.com', password='correct horse!')
+    assert resp.status_code == 200, resp.data
+
+    with serve.app.app_context():
+        sess = serve.gdb.session
+        email = sess.scalar(sqlalchemy.select(accounts.Email))
+        assert email.email == 'new@example.com'
+        assert email.validated_utc < 0
+        assert serve.bcrypt.check_password_hash(
+            email.account.passwords[0].password, 'correct horse!')
+        [message] = sess.scalars(sqlalchemy.select(accounts.Outbox)).all()
+        assert message.recipients == 'new@example.com'
+        assert email.validation_code in message.body
+        assert outbox.summary(sess)['pending'] == 1
+        aid = email.account.id
+
+    path = accounts.path(root, aid)
+    with db.engine(path).connect() as conn:
+        assert conn.exec_driver_sql('SELECT COUNT(*) FROM profiles').scalar() == 1
+        assert migrations.version(conn) == migrations.LATEST
+
+
+def test_register_rejects_bad_input(client):
+    assert _register(client, email='a@example.com\nBcc: b@example.com',
+                     password='correct horse!').status_code == 400
+    assert _register(client, email='b@example.com', password='short').status_code == 400
+    assert _register(client, email='b@example.com',
+                     password='correct horse!').status_code == 200
+    assert _register(client, email='b@example.com',
+                     password='correct horse!').status_code == 409
@@ -0,0 +1,119 @@
+import os
+import sqlite3
+
+import pytest
+
+from omphaloskepsis import accounts, db, measurements
+
+
+@pytest.fixture
+def sess():
+    engine = db.engine(':memory:')
+    measurements.Model.metadata.create_all(engine)
+    return db.sessionmaker(bind=engine, autoflush=False)()
+
+
+def _search(sess, query, **kwargs):
+    return [(h['kind'], h['id'])
+            for h in measurements.search(sess.connection(), query, **kwargs)]
+
+
+def _snapshot(sess, **data):
+    snapshot = measurements.Snapshot()
+    snapshot.update_from(data)
+    sess.add(snapshot)
+    sess.commit()
+    return snapshot
+
+
+def test_index_follows_snapshot_writes(sess):
+    snapshot = _snapshot(sess, utc=100, note='went running in the park')
+    assert _search(sess, 'run') == [('snapshot', snapshot.id)]
+
+    snapshot.update_from(dict(note='slept in'))
+    sess.commit()
+    assert _search(sess, 'run') == []
+    assert _search(sess, 'slept') == [('snapshot', snapshot.id)]
+
+    snapshot.update_from(dict(note=None))
+    sess.commit()
+    assert _search(sess, 'slept') == []
+
+    snapshot.update_from(dict(note='swim'))
+    sess.commit()
+    sess.delete(snapshot)
+    sess.commit()
+    assert _search(sess, 'swim') == []
+
+
+def test_index_follows_collection_goals(sess):
+    habit = measurements.Collection()
+    habit.update_from(dict(flavor='habit', goals='meditate 1 per day'))
+    sess.add(habit)
+    sess.commit()
+    assert _search(sess, 'meditate') == [('collection', habit.id)]
+
+    habit.update_from(dict(goals='stretch 2 per week'))
+    sess.commit()
+    assert _search(sess, 'meditate') == []
+    assert _search(sess, 'stretch') == [('collection', habit.id)]
+
+    sess.delete(habit)
+    sess.commit()
+    assert _search(sess, 'stretch') == []
+
+
+def test_time_filters_only_apply_to_snapshots(sess):
+    early = _snapshot(sess, utc=100, note='yoga class')
+    late = _snapshot(sess, utc=300, note='yoga again')
+    habit = measurements.Collection()
+    habit.update_from(dict(flavor='habit', goals='yoga 3 per week'))
+    sess.add(habit)
+    sess.commit()
+
+    found = set(_search(sess, 'yoga', start=200))
+    assert found == {('snapshot', late.id), ('collection', habit.id)}
+
+    # moving a snapshot in time moves it through the filter.
+    early.utc = 250
+    sess.commit()
+    assert ('snapshot', early.id) in _search(sess, 'yoga', start=200, end=260)
+    assert ('snapshot', late.id) not in _search(sess, 'yoga', start=200, end=260)
+
+
+def test_pagination(sess):
+    for i in range(30):
+        _snapshot(sess, utc=i, note=f'ran {i} km')
+    pages = [_search(sess, 'ran', limit=10, offset=o) for o in (0, 10, 20, 30)]
+    assert [len(p) for p in pages] == [10, 10, 10, 0]
+    assert len({hit for page in pages for hit in page}) == 30
+    assert len(_search(sess, 'ran', limit=-1)) == 1
+    assert len(_search(sess, 'ran', limit=1000)) == 30
+    assert _search(sess, 'ran', limit=5, offset=-5) == _search(sess, 'ran', limit=5)
+
+
+def test_rebuild_matches_live_index(sess):
+    _snapshot(sess, utc=1, note='alpha beta')
+    _snapshot(sess, utc=2, note='beta gamma')
+    before = _search(sess, 'beta')
+    assert measurements.rebuild_search(sess.connection()) == 2
+    sess.commit()
+    assert _search(sess, 'beta') == before
+
+
+def test_legacy_accounts_are_searchable_once_opened(tmp_path):
+    root = str(tmp_path)
+    p = accounts.path(root, 5)
+    os.makedirs(os.path.dirname(p))
+    conn = sqlite3.connect(p)
+    conn.executescript('''
+        CREATE TABLE collections (
+            id INTEGER PRIMARY KEY, flavor VARCHAR NOT NULL, kv BLOB);
+        CREATE TABLE snapshots (id INTEGER PRIMARY KEY, collection_id INTEGER,
+            utc INTEGER NOT NULL, tz VARCHAR, lat FLOAT, lng FLOAT, kv BLOB);
+        CREATE TABLE profiles (id INTEGER PRIMARY KEY, kv BLOB);''')
+    conn.close()
+    sess = db.sessionmaker(bind=accounts.engine(root, 5), autoflush=False)()
+    snapshot = _snapshot(sess, utc=1, note='first note')
+    assert _search(sess, 'note') == [('snapshot', snapshot.id)]
+    sess.close()